@@ -14,80 +14,80 @@
 # ==============================================================================
 """Privacy accountant that uses Renyi differential privacy."""
 
+import collections
+import functools
 import math
-from typing import Collection, Optional, Union
+from typing import Callable, Collection, Dict, Hashable, Optional, Tuple, Union
 
 import numpy as np
 from scipy import special
-import six
 
 from dp_accounting import dp_event
 from dp_accounting import privacy_accountant
+from dp_accounting.rdp import _numba_kernels
 
 NeighborRel = privacy_accountant.NeighboringRelation
 
+# Largest order for which the RDP of the sampled without replacement Gaussian
+# mechanism is computed exactly, larger orders use the Stirling approximation.
+_SAMPLE_WOR_MAX_EXACT_ALPHA = 256
 
-def _log_add(logx, logy):
-  """Adds two numbers in the log space."""
-  a, b = min(logx, logy), max(logx, logy)
-  if a == -np.inf:  # adding 0
-    return b
-  # Use exp(a) + exp(b) = (exp(a - b) + 1) * exp(b)
-  return math.log1p(math.exp(a - b)) + b  # log1p(x) = log(x + 1)
+# Maximum number of RDP vectors memoized by each `RdpAccountant`.
+_RDP_CACHE_MAXSIZE = 512
 
+# Key of the memoized RDP vectors: the RDP function, q and the noise multiplier.
+_RdpCacheKey = Tuple[Callable[..., np.ndarray], float, float]
 
-def _log_sub(logx, logy):
-  """Subtracts two numbers in the log space. Answer must be non-negative."""
-  if logx < logy:
-    raise ValueError('The result of subtraction must be non-negative.')
-  if logy == -np.inf:  # subtracting 0
-    return logx
-  if logx == logy:
-    return -np.inf  # 0 is represented as -np.inf in the log space.
-
-  try:
-    # Use exp(x) - exp(y) = (exp(x - y) - 1) * exp(y).
-    return math.log(math.expm1(logx - logy)) + logy  # expm1(x) = exp(x) - 1
-  except OverflowError:
-    return logx
-
-
-def _log_sub_sign(logx, logy):
-  """Returns log(exp(logx)-exp(logy)) and its sign."""
-  if logx > logy:
-    s = True
-    mag = logx + np.log(1 - np.exp(logy - logx))
-  elif logx < logy:
-    s = False
-    mag = logy + np.log(1 - np.exp(logx - logy))
-  else:
-    s = True
-    mag = -np.inf
 
-  return s, mag
+def _log_comb(n, k, gammaln_table=None):
+  """Computes log of binomial coefficient.
 
+  Args:
+    n: The number of elements.
+    k: The number of chosen elements. Can be an array.
+    gammaln_table: Optional array with gammaln_table[x] = gammaln(x). If given,
+      n and k must be non-negative integers and the table must cover n + 1.
 
-def _log_comb(n, k):
-  """Computes log of binomial coefficient."""
-  return (special.gammaln(n + 1) - special.gammaln(k + 1) -
-          special.gammaln(n - k + 1))
+  Returns:
+    The log of n choose k.
+  """
+  if gammaln_table is None:
+    return (special.gammaln(n + 1) - special.gammaln(k + 1) -
+            special.gammaln(n - k + 1))
+  return (gammaln_table[n + 1] - gammaln_table[k + 1] -
+          gammaln_table[n - k + 1])
 
 
-def _compute_log_a_int(q, sigma, alpha):
-  """Computes log(A_alpha) for integer alpha, 0 < q < 1."""
-  assert isinstance(alpha, six.integer_types)
+def _get_gammaln_table(alpha, gammaln_table=None):
+  """Returns a table of gammaln(x) covering 0 <= x <= alpha + 1.
 
-  # Initialize with 0 in the log space.
-  log_a = -np.inf
+  Args:
+    alpha: The largest integer order the table is needed for.
+    gammaln_table: Optional table to reuse if it is large enough.
 
-  for i in range(alpha + 1):
-    log_coef_i = (
-        _log_comb(alpha, i) + i * math.log(q) + (alpha - i) * math.log(1 - q))
+  Returns:
+    An array with gammaln_table[x] = gammaln(x) for 0 <= x <= alpha + 1.
+  """
+  if gammaln_table is None or len(gammaln_table) < alpha + 2:
+    gammaln_table = special.gammaln(np.arange(alpha + 2))
+  return gammaln_table
 
-    s = log_coef_i + (i * i - i) / (2 * (sigma**2))
-    log_a = _log_add(log_a, s)
 
-  return float(log_a)
+def _compute_log_a_int(q, sigma, alpha, gammaln_table=None):
+  """Computes log(A_alpha) for integer alpha, 0 < q < 1."""
+  assert isinstance(alpha, int)
+  gammaln_table = _get_gammaln_table(alpha, gammaln_table)
+
+  # All alpha + 1 terms of the binomial expansion are summed at once in the log
+  # space.
+  log_q, log_1mq = math.log(q), math.log1p(-q)
+  inv_2sigma2 = 0.5 / (sigma * sigma)
+  i = np.arange(alpha + 1)
+  log_coef = (
+      _log_comb(alpha, i, gammaln_table) + i * log_q + (alpha - i) * log_1mq)
+  s = log_coef + i * (i - 1) * inv_2sigma2
+
+  return float(special.logsumexp(s))
 
 
 def _compute_log_a_frac(q, sigma, alpha):
@@ -95,54 +95,125 @@ def _compute_log_a_frac(q, sigma, alpha):
   # The two parts of A_alpha, integrals over (-inf,z0] and [z0, +inf), are
   # initialized to 0 in the log space:
   log_a0, log_a1 = -np.inf, -np.inf
-  i = 0
+  # The terms of the series are evaluated in blocks, starting small since few
+  # terms are needed for small alpha and doubling up to a cap for large alpha.
+  block_size = 16
+  block_start = 0
 
   z0 = sigma**2 * math.log(1 / q - 1) + .5
 
+  # Constants of the loop below.
+  log_q, log_1mq = math.log(q), math.log1p(-q)
+  log_half = -math.log(2)
+  inv_2sigma2 = 0.5 / (sigma * sigma)
+  inv_sqrt2_sigma = 1 / (math.sqrt(2) * sigma)
+  gammaln_alpha = special.gammaln(alpha + 1)
+
   while True:  # do ... until loop
-    coef = special.binom(alpha, i)
-    log_coef = math.log(abs(coef))
+    i = block_start + np.arange(block_size)
     j = alpha - i
 
-    log_t0 = log_coef + i * math.log(q) + j * math.log(1 - q)
-    log_t1 = log_coef + j * math.log(q) + i * math.log(1 - q)
+    # Log of the absolute value of binom(alpha, i) and its sign. Only
+    # Gamma(alpha - i + 1) in the denominator of binom(alpha, i) can be
+    # negative.
+    log_coef = gammaln_alpha - special.gammaln(i + 1) - special.gammaln(j + 1)
+    signs = special.gammasgn(j + 1)
 
-    log_e0 = math.log(.5) + _log_erfc((i - z0) / (math.sqrt(2) * sigma))
-    log_e1 = math.log(.5) + _log_erfc((z0 - j) / (math.sqrt(2) * sigma))
+    log_t0 = log_coef + i * log_q + j * log_1mq
+    log_t1 = log_coef + j * log_q + i * log_1mq
 
-    log_s0 = log_t0 + (i * i - i) / (2 * (sigma**2)) + log_e0
-    log_s1 = log_t1 + (j * j - j) / (2 * (sigma**2)) + log_e1
+    # The erfc terms of both parts are computed with a single call.
+    log_e = log_half + _log_erfc_vec(
+        np.concatenate([i - z0, z0 - j]) * inv_sqrt2_sigma)
+    log_e0, log_e1 = log_e[:block_size], log_e[block_size:]
 
-    if coef > 0:
-      log_a0 = _log_add(log_a0, log_s0)
-      log_a1 = _log_add(log_a1, log_s1)
-    else:
-      log_a0 = _log_sub(log_a0, log_s0)
-      log_a1 = _log_sub(log_a1, log_s1)
+    log_s0 = log_t0 + i * (i - 1) * inv_2sigma2 + log_e0
+    log_s1 = log_t1 + j * (j - 1) * inv_2sigma2 + log_e1
+
+    # The series is truncated after the first term that is small enough.
+    is_small = np.maximum(log_s0, log_s1) < -30
+    done = is_small.any()
+    if done:
+      num_terms = np.argmax(is_small) + 1
+      log_s0 = log_s0[:num_terms]
+      log_s1 = log_s1[:num_terms]
+      signs = signs[:num_terms]
 
-    i += 1
-    if max(log_s0, log_s1) < -30:
+    log_a0 = _log_add_signed_block(log_a0, log_s0, signs)
+    log_a1 = _log_add_signed_block(log_a1, log_s1, signs)
+
+    if done:
       break
+    block_start += block_size
+    block_size = min(2 * block_size, 256)
 
-  return _log_add(log_a0, log_a1)
-
-
-def _log_erfc(x):
-  """Computes log(erfc(x)) with high accuracy for large x."""
-  try:
-    return math.log(2) + special.log_ndtr(-x * 2**.5)
-  except NameError:
-    # If log_ndtr is not available, approximate as follows:
-    r = special.erfc(x)
-    if r == 0.0:
-      # Using the Laurent series at infinity for the tail of the erfc function:
-      #     erfc(x) ~ exp(-x^2-.5/x^2+.625/x^4)/(x*pi^.5)
-      # To verify in Mathematica:
-      #     Series[Log[Erfc[x]] + Log[x] + Log[Pi]/2 + x^2, {x, Infinity, 6}]
-      return (-math.log(math.pi) / 2 - math.log(x) - x**2 - .5 * x**-2 +
-              .625 * x**-4 - 37. / 24. * x**-6 + 353. / 64. * x**-8)
-    else:
-      return math.log(r)
+  return float(np.logaddexp(log_a0, log_a1))
+
+
+def _log_add_signed_block(log_acc, log_terms, signs):
+  """Adds a block of signed terms to a non-negative sum in the log space.
+
+  Args:
+    log_acc: The log of the non-negative sum so far.
+    log_terms: Array with the log of the absolute values of the terms.
+    signs: Array with the signs of the terms, 1 or -1.
+
+  Returns:
+    The log of the sum of exp(log_acc) and the signed terms.
+
+  Raises:
+    ValueError: If the result is negative.
+  """
+  k = np.argmax(log_terms)
+  m = max(log_acc, log_terms[k])
+  if m == -np.inf:
+    return m
+
+  # The largest term is left out of the sum and added back with log1p, which
+  # keeps the precision when the other terms nearly cancel it.
+  scaled = signs * np.exp(log_terms - m)
+  if log_acc >= log_terms[k]:
+    sign_m = 1.
+    rest = scaled.sum()
+  else:
+    sign_m = scaled[k]
+    scaled[k] = 0.
+    rest = scaled.sum() + math.exp(log_acc - m)
+  if sign_m > 0 and rest > -1:
+    return m + math.log1p(rest)
+  total = sign_m + rest
+  if total < 0:
+    raise ValueError('The result of subtraction must be non-negative.')
+  return m + math.log(total) if total > 0 else -np.inf
+
+
+def _log_erfc_vec(x):
+  """Computes log(erfc(x)) elementwise with high accuracy for large x."""
+  return math.log(2) + special.log_ndtr(-np.asarray(x) * math.sqrt(2))
+
+
+def _check_orders_and_rdp(orders, rdp):
+  """Converts orders and RDP guarantees to arrays and validates them.
+
+  Args:
+    orders: An array of orders.
+    rdp: An array of RDP guarantees of the same length.
+
+  Returns:
+    Pair (orders, rdp) of float arrays.
+
+  Raises:
+    ValueError: If an order is smaller than 1 or an RDP guarantee is negative.
+  """
+  orders = np.asarray(orders, dtype=np.float64)
+  rdp = np.asarray(rdp, dtype=np.float64)
+  if np.any(orders < 1):
+    raise ValueError('Renyi divergence order must be at least 1. Found '
+                     f'{orders[orders < 1][0]}.')
+  if np.any(rdp < 0):
+    raise ValueError(
+        f'Renyi divergence cannot be negative. Found {rdp[rdp < 0][0]}.')
+  return orders, rdp
 
 
 def _compute_delta(orders, rdp, epsilon):
@@ -165,31 +236,26 @@ def _compute_delta(orders, rdp, epsilon):
   if len(orders) != len(rdp):
     raise ValueError('Input lists must have the same length.')
 
+  orders, rdp = _check_orders_and_rdp(orders, rdp)
+
   # Basic bound (see https://arxiv.org/abs/1702.07476 Proposition 3 in v3):
   #   delta = min( np.exp((rdp - epsilon) * (orders - 1)) )
 
   # Improved bound from https://arxiv.org/abs/2004.00010 Proposition 12 (in v4):
-  logdeltas = []  # work in log space to avoid overflows
-  for (a, r) in zip(orders, rdp):
-    if a < 1:
-      raise ValueError(f'Renyi divergence order must be at least 1. Found {a}.')
-    if r < 0:
-      raise ValueError(f'Renyi divergence cannot be negative. Found {r}.')
+  # work in log space to avoid overflows.
+  with np.errstate(divide='ignore', invalid='ignore'):
     # For small alpha, we are better of with bound via KL divergence:
     # delta <= sqrt(1-exp(-KL)).
     # Take a min of the two bounds.
-    if r == 0:
-      logdelta = -np.inf
-    else:
-      logdelta = 0.5 * math.log1p(-math.exp(-r))
-    if a > 1.01:
-      # This bound is not numerically stable as alpha->1.
-      # Thus we have a min value for alpha.
-      # The bound is also not useful for small alpha, so doesn't matter.
-      rdp_bound = (a - 1) * (r - epsilon + math.log1p(-1 / a)) - math.log(a)
-      logdelta = min(logdelta, rdp_bound)
-
-    logdeltas.append(logdelta)
+    logdeltas = np.where(rdp == 0, -np.inf, 0.5 * np.log1p(-np.exp(-rdp)))
+    # This bound is not numerically stable as alpha->1.
+    # Thus we have a min value for alpha.
+    # The bound is also not useful for small alpha, so doesn't matter.
+    rdp_bound = ((orders - 1) * (rdp - epsilon + np.log1p(-1 / orders)) -
+                 np.log(orders))
+    # fmin ignores the NaN bound obtained for an infinite order.
+    logdeltas = np.where(orders > 1.01, np.fmin(logdeltas, rdp_bound),
+                         logdeltas)
 
   return min(math.exp(np.min(logdeltas)), 1.)
 
@@ -213,7 +279,7 @@ def _compute_epsilon(orders, rdp, delta):
     raise ValueError(f'Delta cannot be negative. Found {delta}.')
 
   if delta == 0:
-    if all(r == 0 for r in rdp):
+    if np.all(np.asarray(rdp) == 0):
       return 0
     else:
       return np.inf
@@ -221,71 +287,29 @@ def _compute_epsilon(orders, rdp, delta):
   if len(orders) != len(rdp):
     raise ValueError('Input lists must have the same length.')
 
+  orders, rdp = _check_orders_and_rdp(orders, rdp)
+
   # Basic bound (see https://arxiv.org/abs/1702.07476 Proposition 3 in v3):
   #   epsilon = min( rdp - math.log(delta) / (orders - 1) )
 
   # Improved bound from https://arxiv.org/abs/2004.00010 Proposition 12 (in v4).
   # Also appears in https://arxiv.org/abs/2001.05990 Equation 20 (in v1).
-  eps = []
-  for (a, r) in zip(orders, rdp):
-    if a < 1:
-      raise ValueError(f'Renyi divergence order must be at least 1. Found {a}.')
-    if r < 0:
-      raise ValueError(f'Renyi divergence cannot be negative. Found {r}.')
-
-    if delta**2 + math.expm1(-r) > 0:
-      # In this case, we can simply bound via KL divergence:
-      # delta <= sqrt(1-exp(-KL)).
-      epsilon = 0  # No need to try further computation if we have epsilon = 0.
-    elif a > 1.01:
-      # This bound is not numerically stable as alpha->1.
-      # Thus we have a min value of alpha.
-      # The bound is also not useful for small alpha, so doesn't matter.
-      epsilon = r + math.log1p(-1 / a) - math.log(delta * a) / (a - 1)
-    else:
-      # In this case we can't do anything. E.g., asking for delta = 0.
-      epsilon = np.inf
-    eps.append(epsilon)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    # This bound is not numerically stable as alpha->1.
+    # Thus we have a min value of alpha.
+    # The bound is also not useful for small alpha, so doesn't matter.
+    # Below that we can't do anything. E.g., asking for delta = 0.
+    eps = np.where(
+        orders > 1.01,
+        rdp + np.log1p(-1 / orders) - np.log(delta * orders) / (orders - 1),
+        np.inf)
+    # Where we can simply bound via KL divergence, delta <= sqrt(1-exp(-KL)),
+    # we have epsilon = 0.
+    eps = np.where(delta**2 + np.expm1(-rdp) > 0, 0, eps)
 
   return max(0, np.min(eps))
 
 
-def _stable_inplace_diff_in_log(vec, signs, n=-1):
-  """Replaces the first n-1 dims of vec with the log of abs difference operator.
-
-  Args:
-    vec: numpy array of floats with size larger than 'n'
-    signs: Optional numpy array of bools with the same size as vec in case one
-      needs to compute partial differences vec and signs jointly describe a
-      vector of real numbers' sign and abs in log scale.
-    n: Optonal upper bound on number of differences to compute. If negative, all
-      differences are computed.
-
-  Returns:
-    The first n-1 dimension of vec and signs will store the log-abs and sign of
-    the difference.
-
-  Raises:
-    ValueError: If input is malformed.
-  """
-
-  assert vec.shape == signs.shape
-  if n < 0:
-    n = np.max(vec.shape) - 1
-  else:
-    assert np.max(vec.shape) >= n + 1
-  for j in range(0, n, 1):
-    if signs[j] == signs[j + 1]:  # When the signs are the same
-      # if the signs are both positive, then we can just use the standard one
-      signs[j], vec[j] = _log_sub_sign(vec[j + 1], vec[j])
-      # otherwise, we do that but toggle the sign
-      if not signs[j + 1]:
-        signs[j] = ~signs[j]
-    else:  # When the signs are different.
-      vec[j] = _log_add(vec[j], vec[j + 1])
-      signs[j] = signs[j + 1]
-
-
 def _get_forward_diffs(fun, n):
   """Computes up to nth order forward difference evaluated at 0.
 
@@ -296,32 +320,28 @@ def _get_forward_diffs(fun, n):
     n: Number of differences to compute.
 
   Returns:
-    Pair (deltas, signs_deltas) of the log deltas and their signs.
+    Pair (deltas, signs_deltas) of the log deltas and their signs, stored as
+    int8 values 1 or -1.
   """
   func_vec = np.zeros(n + 3)
-  signs_func_vec = np.ones(n + 3, dtype=bool)
-
-  # ith coordinate of deltas stores log(abs(ith order discrete derivative))
-  deltas = np.zeros(n + 2)
-  signs_deltas = np.zeros(n + 2, dtype=bool)
+  signs_func_vec = np.ones(n + 3, dtype=np.int8)
   for i in range(1, n + 3, 1):
     func_vec[i] = fun(1.0 * (i - 1))
-  for i in range(0, n + 2, 1):
-    # Diff in log scale
-    _stable_inplace_diff_in_log(func_vec, signs_func_vec, n=n + 2 - i)
-    deltas[i] = func_vec[0]
-    signs_deltas[i] = signs_func_vec[0]
-  return deltas, signs_deltas
+  return _numba_kernels.forward_diffs_in_log(func_vec, signs_func_vec)
 
 
-def _compute_log_a(q, noise_multiplier, alpha):
-  if float(alpha).is_integer():
-    return _compute_log_a_int(q, noise_multiplier, int(alpha))
+def _compute_log_a(q, noise_multiplier, alpha, gammaln_table=None):
+  alpha_int = int(alpha)
+  if alpha_int == alpha:
+    return _compute_log_a_int(q, noise_multiplier, alpha_int, gammaln_table)
   else:
     return _compute_log_a_frac(q, noise_multiplier, alpha)
 
 
-def _compute_rdp_poisson_subsampled_gaussian(q, noise_multiplier, orders):
+def _compute_rdp_poisson_subsampled_gaussian(q,
+                                             noise_multiplier,
+                                             orders,
+                                             gammaln_table=None):
   """Computes RDP of the Poisson sampled Gaussian mechanism.
 
   Args:
@@ -329,6 +349,8 @@ def _compute_rdp_poisson_subsampled_gaussian(q, noise_multiplier, orders):
     noise_multiplier: The ratio of the standard deviation of the Gaussian noise
       to the l2-sensitivity of the function to which it is added.
     orders: An array of RDP orders.
+    gammaln_table: Optional precomputed table of gammaln at integers, as
+      returned by `_get_gammaln_table`.
 
   Returns:
     The RDPs at all orders. Can be `np.inf`.
@@ -344,12 +366,16 @@ def _compute_rdp_poisson_subsampled_gaussian(q, noise_multiplier, orders):
     if q == 1.:
       return alpha / (2 * noise_multiplier**2)
 
-    return _compute_log_a(q, noise_multiplier, alpha) / (alpha - 1)
+    return _compute_log_a(q, noise_multiplier, alpha,
+                          gammaln_table) / (alpha - 1)
 
   return np.array([compute_one_order(q, order) for order in orders])
 
 
-def _compute_rdp_sample_wor_gaussian(q, noise_multiplier, orders):
+def _compute_rdp_sample_wor_gaussian(q,
+                                     noise_multiplier,
+                                     orders,
+                                     gammaln_table=None):
   """Computes RDP of Gaussian mechanism using sampling without replacement.
 
   This function applies to the following schemes:
@@ -367,23 +393,78 @@ def _compute_rdp_sample_wor_gaussian(q, noise_multiplier, orders):
     noise_multiplier: The ratio of the standard deviation of the Gaussian noise
       to the l2-sensitivity of the function to which it is added.
     orders: An array of RDP orders.
+    gammaln_table: Optional precomputed table of gammaln at integers, as
+      returned by `_get_gammaln_table`.
 
   Returns:
     The RDPs at all orders, can be np.inf.
   """
+  orders = np.asarray(orders, dtype=np.float64)
+  deltas = None
+  finite_orders = orders[np.isfinite(orders)]
+  if 0 < q < 1 and noise_multiplier > 0 and finite_orders.size:
+    # The forward differences up to the largest order that is computed exactly
+    # start with the forward differences of every smaller order, so they are
+    # computed once and shared by all orders.
+    max_alpha = min(
+        int(math.ceil(np.max(finite_orders))), _SAMPLE_WOR_MAX_EXACT_ALPHA)
+    deltas = _get_sample_wor_forward_diffs(noise_multiplier, max_alpha)
+
   return np.array([
-      _compute_rdp_sample_wor_gaussian_scalar(q, noise_multiplier, order)
+      _compute_rdp_sample_wor_gaussian_scalar(q, noise_multiplier, order,
+                                              gammaln_table, deltas)
       for order in orders
   ])
 
 
-def _compute_rdp_sample_wor_gaussian_scalar(q, sigma, alpha):
+def _get_sample_wor_forward_diffs(sigma, alpha):
+  """Computes the log forward differences of exp(cgf) up to order alpha.
+
+  Args:
+    sigma: The std of the additive Gaussian noise.
+    alpha: The largest order of the forward differences.
+
+  Returns:
+    The log of the absolute forward differences, as returned by
+    `_get_forward_diffs`.
+  """
+  # We need forward differences of exp(cgf)
+  # The following line is the numerically stable way of implementing it.
+  # The output is in polar form with logarithmic magnitude
+  deltas, _ = _get_forward_diffs(
+      functools.partial(_sample_wor_cgf, sigma=sigma), alpha)
+  return deltas
+
+
+def _sample_wor_cgf(x, sigma):
+  """Returns rdp(x + 1) * x for the Gaussian mechanism with noise sigma.
+
+  The RDP of the Gaussian mechanism at order alpha is alpha / (2 * sigma**2).
+
+  Args:
+    x: The order minus one. Can be an array.
+    sigma: The std of the additive Gaussian noise.
+
+  Returns:
+    rdp(x + 1) * x.
+  """
+  return x * 1.0 * (x + 1) / (2.0 * sigma**2)
+
+
+def _compute_rdp_sample_wor_gaussian_scalar(q,
+                                            sigma,
+                                            alpha,
+                                            gammaln_table=None,
+                                            deltas=None):
   """Compute RDP of the Sampled Gaussian mechanism at order alpha.
 
   Args:
     q: The sampling proportion =  m / n.  Assume m is an integer <= n.
     sigma: The std of the additive Gaussian noise.
     alpha: The order at which RDP is computed.
+    gammaln_table: Optional precomputed table of gammaln at integers.
+    deltas: Optional forward differences shared between orders, as returned by
+      `_get_sample_wor_forward_diffs`.
 
   Returns:
     RDP at alpha, can be np.inf.
@@ -400,22 +481,29 @@ def _compute_rdp_sample_wor_gaussian_scalar(q, sigma, alpha):
   if np.isinf(alpha):
     return np.inf
 
-  if float(alpha).is_integer():
-    return _compute_rdp_sample_wor_gaussian_int(q, sigma, int(alpha)) / (
-        alpha - 1)
+  alpha_int = int(alpha)
+  if alpha_int == alpha:
+    return _compute_rdp_sample_wor_gaussian_int(
+        q, sigma, alpha_int, gammaln_table, deltas) / (alpha - 1)
   else:
     # When alpha not an integer, we apply Corollary 10 of [WBK19] to interpolate
     # the CGF and obtain an upper bound
     alpha_f = math.floor(alpha)
     alpha_c = math.ceil(alpha)
 
-    x = _compute_rdp_sample_wor_gaussian_int(q, sigma, alpha_f)
-    y = _compute_rdp_sample_wor_gaussian_int(q, sigma, alpha_c)
+    x = _compute_rdp_sample_wor_gaussian_int(q, sigma, alpha_f, gammaln_table,
+                                             deltas)
+    y = _compute_rdp_sample_wor_gaussian_int(q, sigma, alpha_c, gammaln_table,
+                                             deltas)
     t = alpha - alpha_f
     return ((1 - t) * x + t * y) / (alpha - 1)
 
 
-def _compute_rdp_sample_wor_gaussian_int(q, sigma, alpha):
+def _compute_rdp_sample_wor_gaussian_int(q,
+                                         sigma,
+                                         alpha,
+                                         gammaln_table=None,
+                                         deltas=None):
   """Compute log(A_alpha) for integer alpha, subsampling without replacement.
 
   When alpha is smaller than max_alpha, compute the bound Theorem 27 exactly,
@@ -425,63 +513,126 @@ def _compute_rdp_sample_wor_gaussian_int(q, sigma, alpha):
     q: The sampling proportion = m / n.  Assume m is an integer <= n.
     sigma: The std of the additive Gaussian noise.
     alpha: The order at which RDP is computed.
+    gammaln_table: Optional precomputed table of gammaln at integers.
+    deltas: Optional forward differences up to at least order alpha, as returned
+      by `_get_sample_wor_forward_diffs`. Computed if not given.
 
   Returns:
     RDP at alpha, can be np.inf.
   """
 
-  max_alpha = 256
-  assert isinstance(alpha, six.integer_types)
+  max_alpha = _SAMPLE_WOR_MAX_EXACT_ALPHA
+  assert isinstance(alpha, int)
 
   if np.isinf(alpha):
     return np.inf
   elif alpha == 1:
     return 0
 
-  def cgf(x):
-    # Return rdp(x+1)*x, the rdp of Gaussian mechanism is alpha/(2*sigma**2)
-    return x * 1.0 * (x + 1) / (2.0 * sigma**2)
+  gammaln_table = _get_gammaln_table(alpha, gammaln_table)
 
   def func(x):
     # Return the rdp of Gaussian mechanism
     return 1.0 * x / (2.0 * sigma**2)
 
-  # Initialize with 1 in the log space.
-  log_a = 0
+  log_q, log_2, log_4 = np.log(q), np.log(2), np.log(4)
+
   # Calculates the log term when alpha = 2
-  log_f2m1 = func(2.0) + np.log(1 - np.exp(-func(2.0)))
+  f2 = func(2.0)
+  log_f2m1 = f2 + np.log(1 - np.exp(-f2))
+  s2 = 2 * log_q + _log_comb(alpha, 2, gammaln_table) + np.minimum(
+      log_4 + log_f2m1, f2 + log_2)
+
+  # The log terms for i > 2 are computed at once.
+  i = np.arange(3, alpha + 1)
+  s_bound = log_2 + _sample_wor_cgf(i - 1, sigma)
   if alpha <= max_alpha:
-    # We need forward differences of exp(cgf)
-    # The following line is the numerically stable way of implementing it.
-    # The output is in polar form with logarithmic magnitude
-    deltas, _ = _get_forward_diffs(cgf, alpha)
+    if deltas is None or len(deltas) < alpha + 2:
+      deltas = _get_sample_wor_forward_diffs(sigma, alpha)
     # Compute the bound exactly requires book keeping of O(alpha**2)
-
-    for i in range(2, alpha + 1):
-      if i == 2:
-        s = 2 * np.log(q) + _log_comb(alpha, 2) + np.minimum(
-            np.log(4) + log_f2m1,
-            func(2.0) + np.log(2))
-      elif i > 2:
-        delta_lo = deltas[int(2 * np.floor(i / 2.0)) - 1]
-        delta_hi = deltas[int(2 * np.ceil(i / 2.0)) - 1]
-        s = np.log(4) + 0.5 * (delta_lo + delta_hi)
-        s = np.minimum(s, np.log(2) + cgf(i - 1))
-        s += i * np.log(q) + _log_comb(alpha, i)
-      log_a = _log_add(log_a, s)
-    return float(log_a)
+    delta_lo = deltas[2 * (i // 2) - 1]
+    delta_hi = deltas[2 * ((i + 1) // 2) - 1]
+    s = np.minimum(log_4 + 0.5 * (delta_lo + delta_hi), s_bound)
   else:
     # Compute the bound with stirling approximation. Everything is O(x) now.
-    for i in range(2, alpha + 1):
-      if i == 2:
-        s = 2 * np.log(q) + _log_comb(alpha, 2) + np.minimum(
-            np.log(4) + log_f2m1,
-            func(2.0) + np.log(2))
-      else:
-        s = np.log(2) + cgf(i - 1) + i * np.log(q) + _log_comb(alpha, i)
-      log_a = _log_add(log_a, s)
+    s = s_bound
+  s += i * log_q + _log_comb(alpha, i, gammaln_table)
+
+  # The sum starts with 1, i.e. 0 in the log space.
+  return float(special.logsumexp(np.concatenate(([0, s2], s))))
+
+
+def _event_key(event: dp_event.DpEvent) -> Hashable:
+  """Returns a hashable key that is equal for events with equal parameters.
+
+  `DpEvent`s holding lists, such as `dp_event.ComposedDpEvent`, are not
+  hashable themselves, so the key is built recursively from their parameters.
+  Events of unknown types are keyed by identity.
 
-    return log_a
+  Args:
+    event: A `dp_event.DpEvent`.
+
+  Returns:
+    A hashable key for `event`.
+  """
+  if isinstance(event, (dp_event.NoOpDpEvent, dp_event.NonPrivateDpEvent)):
+    return (type(event).__name__,)
+  elif isinstance(event, dp_event.GaussianDpEvent):
+    return ('gaussian', event.noise_multiplier)
+  elif isinstance(event, dp_event.SelfComposedDpEvent):
+    return ('self_composed', event.count, _event_key(event.event))
+  elif isinstance(event, dp_event.ComposedDpEvent):
+    return ('composed', tuple(_event_key(e) for e in event.events))
+  elif isinstance(event, dp_event.PoissonSampledDpEvent):
+    return ('poisson_sampled', event.sampling_probability,
+            _event_key(event.event))
+  elif isinstance(event, dp_event.SampledWithReplacementDpEvent):
+    return ('sampled_with_replacement', event.source_dataset_size,
+            event.sample_size, _event_key(event.event))
+  elif isinstance(event, dp_event.SampledWithoutReplacementDpEvent):
+    return ('sampled_without_replacement', event.source_dataset_size,
+            event.sample_size, _event_key(event.event))
+  elif isinstance(event, dp_event.SingleEpochTreeAggregationDpEvent):
+    step_counts = event.step_counts
+    if not np.isscalar(step_counts):
+      step_counts = tuple(step_counts)
+    return ('single_epoch_tree_aggregation', event.noise_multiplier,
+            step_counts)
+  else:
+    return ('unknown', id(event))
+
+
+def _flatten_events(
+    event: dp_event.DpEvent,
+    count: int,
+    leaves: Optional[Dict[Hashable, Tuple[dp_event.DpEvent, int]]] = None
+) -> Dict[Hashable, Tuple[dp_event.DpEvent, int]]:
+  """Aggregates identical leaves of nested compositions of `event`.
+
+  `dp_event.ComposedDpEvent` and `dp_event.SelfComposedDpEvent` are expanded
+  recursively. Every other event is a leaf, and leaves with equal parameters
+  are merged by summing the number of times they are composed.
+
+  Args:
+    event: A `dp_event.DpEvent` to flatten.
+    count: The number of times `event` is composed.
+    leaves: Optional dictionary to accumulate the leaves into.
+
+  Returns:
+    A dictionary mapping `_event_key(leaf)` to pairs (leaf, total_count).
+  """
+  if leaves is None:
+    leaves = {}
+  if isinstance(event, dp_event.SelfComposedDpEvent):
+    _flatten_events(event.event, event.count * count, leaves)
+  elif isinstance(event, dp_event.ComposedDpEvent):
+    for e in event.events:
+      _flatten_events(e, count, leaves)
+  else:
+    key = _event_key(event)
+    leaf, leaf_count = leaves.get(key, (event, 0))
+    leaves[key] = (leaf, leaf_count + count)
+  return leaves
 
 
 def _effective_gaussian_noise_multiplier(event: dp_event.DpEvent):
@@ -520,6 +671,42 @@ def _effective_gaussian_noise_multiplier(event: dp_event.DpEvent):
     return None
 
 
+@functools.lru_cache(maxsize=256)
+def _effective_gaussian_noise_multiplier_from_key(key: Hashable):
+  """Computes `_effective_gaussian_noise_multiplier` from an `_event_key`.
+
+  The result is cached by the key of the outermost event only, the nested keys
+  are not looked up in the cache.
+
+  Args:
+    key: The key of an event, as returned by `_event_key`.
+
+  Returns:
+    The effective noise multiplier of the event, or None.
+  """
+  return _effective_gaussian_noise_multiplier_of_key(key)
+
+
+def _effective_gaussian_noise_multiplier_of_key(key: Hashable):
+  """Uncached recursion of `_effective_gaussian_noise_multiplier_from_key`."""
+  if key[0] == 'gaussian':
+    return key[1]
+  elif key[0] == 'composed':
+    sum_sigma_inv_sq = 0
+    for k in key[1]:
+      sigma = _effective_gaussian_noise_multiplier_of_key(k)
+      if sigma is None:
+        return None
+      sum_sigma_inv_sq += sigma**-2
+    return sum_sigma_inv_sq**-0.5
+  elif key[0] == 'self_composed':
+    count, sub_key = key[1:]
+    sigma = _effective_gaussian_noise_multiplier_of_key(sub_key)
+    return None if sigma is None else (count * sigma**-2)**-0.5
+  else:
+    return None
+
+
 def _compute_rdp_single_epoch_tree_aggregation(
     noise_multiplier: float, step_counts: Union[int, Collection[int]],
     orders: Collection[float]) -> Collection[float]:
@@ -559,8 +746,11 @@ def _compute_rdp_single_epoch_tree_aggregation(
     if steps < 0:
       raise ValueError(f'Steps must be non-negative. Got {step_counts}')
 
-  max_depth = max(math.ceil(math.log2(steps + 1)) for steps in step_counts)
-  return np.array([a * max_depth / (2 * noise_multiplier**2) for a in orders])
+  # The depth of a tree with steps leaves is ceil(log2(steps + 1)), computed
+  # exactly with integer arithmetic.
+  max_depth = max(int(steps).bit_length() for steps in step_counts)
+  return (max_depth / (2 * noise_multiplier**2)) * np.asarray(
+      orders, dtype=np.float64)
 
 
 class RdpAccountant(privacy_accountant.PrivacyAccountant):
@@ -582,15 +772,92 @@ class RdpAccountant(privacy_accountant.PrivacyAccountant):
       ]
     self._orders = np.array(orders)
     self._rdp = np.zeros_like(orders, dtype=np.float64)
+    # Buffer for the RDP of each composition, so that composing does not
+    # allocate a new array.
+    self._scratch = np.empty_like(self._rdp)
+    # Table of gammaln at integers large enough for all finite orders, shared by
+    # every composition so binomial coefficients are not recomputed each time.
+    # Built by `_shared_gammaln_table` the first time it is needed.
+    self._gammaln_table: Optional[np.ndarray] = None
+    # RDP vectors of the most recently composed subsampled Gaussian mechanisms,
+    # keyed by the RDP function and its parameters, in least recently used
+    # order. Repeated compositions of the same mechanism, as in DP-SGD, then
+    # evaluate the RDP only once.
+    self._rdp_cache: 'collections.OrderedDict[_RdpCacheKey, np.ndarray]' = (
+        collections.OrderedDict())
+
+  def _shared_gammaln_table(self) -> np.ndarray:
+    """Returns the table of gammaln covering all finite orders.
+
+    Returns:
+      An array with table[x] = gammaln(x) for 0 <= x <= max order + 1.
+    """
+    if self._gammaln_table is None:
+      finite_orders = self._orders[np.isfinite(self._orders)]
+      max_order = int(math.ceil(max(finite_orders, default=0)))
+      self._gammaln_table = _get_gammaln_table(max_order)
+    return self._gammaln_table
+
+  def _cached_rdp(self, compute_rdp: Callable[..., np.ndarray], q: float,
+                  noise_multiplier: float) -> np.ndarray:
+    """Returns `compute_rdp` evaluated at all orders, memoized by parameters.
+
+    Args:
+      compute_rdp: Either `_compute_rdp_poisson_subsampled_gaussian` or
+        `_compute_rdp_sample_wor_gaussian`.
+      q: The sampling rate or proportion.
+      noise_multiplier: The noise multiplier of the Gaussian mechanism.
+
+    Returns:
+      A read-only array with the RDP at each of `self._orders`.
+    """
+    key = (compute_rdp, q, noise_multiplier)
+    rdp = self._rdp_cache.get(key)
+    if rdp is not None:
+      self._rdp_cache.move_to_end(key)
+      return rdp
+    # Only subsampling rates strictly between 0 and 1 use binomial expansions.
+    gammaln_table = self._shared_gammaln_table() if 0 < q < 1 else None
+    rdp = compute_rdp(
+        q=q,
+        noise_multiplier=noise_multiplier,
+        orders=self._orders,
+        gammaln_table=gammaln_table)
+    rdp.flags.writeable = False
+    self._rdp_cache[key] = rdp
+    if len(self._rdp_cache) > _RDP_CACHE_MAXSIZE:
+      self._rdp_cache.popitem(last=False)
+    return rdp
 
   def supports(self, event: dp_event.DpEvent) -> bool:
     return self._maybe_compose(event, 0, False)
 
   def _compose(self, event: dp_event.DpEvent, count: int = 1):
-    self._maybe_compose(event, count, True)
+    # Evaluate the RDP of each distinct leaf once, however many times it is
+    # repeated in the (nested) composition.
+    for key, (leaf, leaf_count) in _flatten_events(event, count).items():
+      self._maybe_compose(leaf, leaf_count, True, key)
+
+  def _add_rdp(self, rdp: Union[float, np.ndarray], scale: float):
+    """Adds `scale` times `rdp` to the RDP accumulated so far.
+
+    The product is written into a preallocated buffer, so no array is
+    allocated.
 
-  def _maybe_compose(self, event: dp_event.DpEvent, count: int,
-                     do_compose: bool) -> bool:
+    Args:
+      rdp: An array with a value at each of `self._orders`, or a scalar for all
+        orders.
+      scale: The factor to multiply `rdp` by, usually the number of times the
+        event is composed.
+    """
+    np.multiply(rdp, scale, out=self._scratch)
+    self._rdp += self._scratch
+
+  def _maybe_compose(self,
+                     event: dp_event.DpEvent,
+                     count: int,
+                     do_compose: bool,
+                     key: Optional[Hashable] = None) -> bool:
     """Traverses `event` and performs composition if `do_compose` is True.
 
     If `do_compose` is False, can be used to check whether composition is
@@ -600,6 +867,8 @@ class RdpAccountant(privacy_accountant.PrivacyAccountant):
       event: A `DpEvent` to process.
       count: The number of times to compose the event.
       do_compose: Whether to actually perform the composition.
+      key: Optional `_event_key(event)`, if already computed. Used to look up
+        the effective noise multiplier of sampled events.
 
     Returns:
       True if event is supported, otherwise False.
@@ -618,41 +887,58 @@ class RdpAccountant(privacy_accountant.PrivacyAccountant):
           self._maybe_compose(e, count, do_compose) for e in event.events)
     elif isinstance(event, dp_event.GaussianDpEvent):
       if do_compose:
-        self._rdp += count * _compute_rdp_poisson_subsampled_gaussian(
-            q=1.0, noise_multiplier=event.noise_multiplier, orders=self._orders)
+        # The RDP of the Gaussian mechanism is alpha / (2 * sigma**2).
+        if event.noise_multiplier == 0:
+          self._rdp += np.inf
+        else:
+          self._add_rdp(self._orders, count / (2 * event.noise_multiplier**2))
       return True
     elif isinstance(event, dp_event.PoissonSampledDpEvent):
       if self._neighboring_relation is not NeighborRel.ADD_OR_REMOVE_ONE:
         return False
-      gaussian_noise_multiplier = _effective_gaussian_noise_multiplier(
-          event.event)
+      if key is None:
+        gaussian_noise_multiplier = _effective_gaussian_noise_multiplier(
+            event.event)
+      else:
+        # The key of a sampled event ends with the key of the event it samples.
+        gaussian_noise_multiplier = (
+            _effective_gaussian_noise_multiplier_from_key(key[-1]))
       if gaussian_noise_multiplier is None:
         return False
       if do_compose:
-        self._rdp += count * _compute_rdp_poisson_subsampled_gaussian(
-            q=event.sampling_probability,
-            noise_multiplier=gaussian_noise_multiplier,
-            orders=self._orders)
+        self._add_rdp(
+            self._cached_rdp(
+                _compute_rdp_poisson_subsampled_gaussian,
+                q=event.sampling_probability,
+                noise_multiplier=gaussian_noise_multiplier), count)
       return True
     elif isinstance(event, dp_event.SampledWithoutReplacementDpEvent):
       if self._neighboring_relation is not NeighborRel.REPLACE_ONE:
         return False
-      gaussian_noise_multiplier = _effective_gaussian_noise_multiplier(
-          event.event)
+      if key is None:
+        gaussian_noise_multiplier = _effective_gaussian_noise_multiplier(
+            event.event)
+      else:
+        # The key of a sampled event ends with the key of the event it samples.
+        gaussian_noise_multiplier = (
+            _effective_gaussian_noise_multiplier_from_key(key[-1]))
       if gaussian_noise_multiplier is None:
         return False
       if do_compose:
-        self._rdp += count * _compute_rdp_sample_wor_gaussian(
-            q=event.sample_size / event.source_dataset_size,
-            noise_multiplier=gaussian_noise_multiplier,
-            orders=self._orders)
+        self._add_rdp(
+            self._cached_rdp(
+                _compute_rdp_sample_wor_gaussian,
+                q=event.sample_size / event.source_dataset_size,
+                noise_multiplier=gaussian_noise_multiplier), count)
       return True
     elif isinstance(event, dp_event.SingleEpochTreeAggregationDpEvent):
       if self._neighboring_relation is not NeighborRel.REPLACE_SPECIAL:
         return False
       if do_compose:
-        self._rdp += count * _compute_rdp_single_epoch_tree_aggregation(
-            event.noise_multiplier, event.step_counts, self._orders)
+        self._add_rdp(
+            _compute_rdp_single_epoch_tree_aggregation(
+                event.noise_multiplier, event.step_counts, self._orders),
+            count)
       return True
     else:
       # Unsupported event (including `UnsupportedDpEvent`).
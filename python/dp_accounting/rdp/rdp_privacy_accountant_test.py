@@ -171,6 +171,65 @@ class RdpPrivacyAccountantTest(privacy_accountant_test.PrivacyAccountantTest,
     self.assertAlmostEqual(rdp_with_heterogeneous_compose,
                            base_rdp + base_rdp_2)
 
+  def test_repeated_composition_reuses_rdp(self):
+    event = dp_event.PoissonSampledDpEvent(0.01, dp_event.GaussianDpEvent(1.5))
+    accountant = rdp_privacy_accountant.RdpAccountant()
+    for _ in range(10):
+      accountant.compose(event)
+    self.assertLen(accountant._rdp_cache, 1)
+
+    expected = rdp_privacy_accountant.RdpAccountant()
+    expected.compose(event, 10)
+    np.testing.assert_allclose(accountant._rdp, expected._rdp, rtol=1e-12)
+
+  def test_gammaln_table_is_built_lazily(self):
+    accountant = rdp_privacy_accountant.RdpAccountant([2, 1e7])
+    accountant.compose(dp_event.GaussianDpEvent(1.0))
+    accountant.compose(
+        dp_event.PoissonSampledDpEvent(1.0, dp_event.GaussianDpEvent(1.0)))
+    self.assertIsNone(accountant._gammaln_table)
+
+    accountant = rdp_privacy_accountant.RdpAccountant([2, 3.5, np.inf])
+    accountant.compose(
+        dp_event.PoissonSampledDpEvent(0.1, dp_event.GaussianDpEvent(1.0)))
+    self.assertLen(accountant._gammaln_table, 6)
+
+  def test_rdp_cache_is_bounded(self):
+    accountant = rdp_privacy_accountant.RdpAccountant([2, 3])
+    first_event = dp_event.PoissonSampledDpEvent(1e-4,
+                                                 dp_event.GaussianDpEvent(1.0))
+    accountant.compose(first_event)
+    for i in range(rdp_privacy_accountant._RDP_CACHE_MAXSIZE):
+      accountant.compose(
+          dp_event.PoissonSampledDpEvent(0.01 + i * 1e-5,
+                                         dp_event.GaussianDpEvent(1.0)))
+      if i == 0:
+        # Using an entry makes it the most recently used one.
+        accountant.compose(first_event)
+    self.assertLen(accountant._rdp_cache,
+                   rdp_privacy_accountant._RDP_CACHE_MAXSIZE)
+    cached_qs = [q for _, q, _ in accountant._rdp_cache]
+    self.assertIn(1e-4, cached_qs)
+    self.assertNotIn(0.01, cached_qs)
+
+  def test_flatten_events(self):
+    gaussian = dp_event.GaussianDpEvent(1.0)
+    sampled = dp_event.PoissonSampledDpEvent(
+        0.1, dp_event.ComposedDpEvent([gaussian, gaussian]))
+    event = dp_event.ComposedDpEvent([
+        dp_event.SelfComposedDpEvent(gaussian, 3),
+        dp_event.ComposedDpEvent([sampled, dp_event.GaussianDpEvent(1.0)]),
+        dp_event.SelfComposedDpEvent(
+            dp_event.ComposedDpEvent([
+                sampled,
+                dp_event.PoissonSampledDpEvent(
+                    0.1, dp_event.ComposedDpEvent([gaussian, gaussian]))
+            ]), 5),
+    ])
+
+    leaves = rdp_privacy_accountant._flatten_events(event, 2)
+    self.assertEqual(list(leaves.values()), [(gaussian, 8), (sampled, 22)])
+
   def test_zero_poisson_sample(self):
     accountant = rdp_privacy_accountant.RdpAccountant([3.14159])
     accountant.compose(
@@ -255,6 +314,19 @@ class RdpPrivacyAccountantTest(privacy_accountant_test.PrivacyAccountantTest,
             ],
             rtol=1e-4))
 
+  def test_compute_rdp_sample_wor_gaussian_high_order(self):
+    # With large noise the high order forward differences are dominated by
+    # rounding errors, which only make the bound looser. The value of the same
+    # bound computed with mpmath is 0.008812.
+    accountant = rdp_privacy_accountant.RdpAccountant(
+        [256], privacy_accountant.NeighboringRelation.REPLACE_ONE)
+    accountant.compose(
+        dp_event.SampledWithoutReplacementDpEvent(
+            1000, 100, dp_event.GaussianDpEvent(20.0)))
+    self.assertGreaterEqual(accountant._rdp[0], 0.008812)
+    # The bound must stay below the RDP without sampling, 256 / (2 * 20**2).
+    self.assertLess(accountant._rdp[0], 0.32)
+
   def test_compute_epsilon_delta_pure_dp(self):
     orders = range(2, 33)
     rdp = [1.1 for o in orders]  # Constant corresponds to pure DP.
@@ -421,6 +493,20 @@ class RdpPrivacyAccountantTest(privacy_accountant_test.PrivacyAccountantTest,
 
     self.assertEqual(single_rdp, max_rdp)
 
+  @parameterized.named_parameters(
+      ('zero', 0, 0),
+      ('one', 1, 1),
+      ('below_power_of_two', 1023, 10),
+      ('power_of_two', 1024, 11),
+      ('large_power_of_two', 2**53, 54),
+  )
+  def test_tree_depth(self, step_count, depth):
+    sigma = 0.5
+    orders = np.array([1.0, 2.5])
+    rdp = rdp_privacy_accountant._compute_rdp_single_epoch_tree_aggregation(
+        sigma, [step_count], orders)
+    np.testing.assert_allclose(rdp, depth * orders / (2 * sigma**2))
+
   @parameterized.named_parameters(
       ('restart4', [400] * 4),
       ('restart2', [800] * 2),